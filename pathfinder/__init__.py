@@ -4,5 +4,35 @@ from ._find import find
 from .api import ModelAPI
 from .chat import *
 from .loader import get_model
-from .model import Model as PathFinderModel
 from .roles import assistant, system, user
+
+__all__ = [
+    "gen",
+    "select",
+    "find",
+    "ModelAPI",
+    "LlamaChat",
+    "Llama3Chat",
+    "MixtralInstruct",
+    "Vicuna",
+    "ChatML",
+    "Phi3",
+    "DeepSeek",
+    "MetaMath",
+    "MistralInstruct",
+    "Cohere",
+    "get_model",
+    "PathFinderModel",
+    "assistant",
+    "system",
+    "user",
+]
+
+
+def __getattr__(name):
+    # the transformers backend pulls in torch, so only import it when used
+    if name in ("Model", "PathFinderModel"):
+        from .model import Model
+
+        return Model
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,22 +1,38 @@
-import copy
+import asyncio
+import functools
+import json
 import logging
-from time import sleep
-from typing import Any
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 
 import backoff
 import regex
-from dotenv import load_dotenv
 
 from ._find import Find
 from ._gen import Gen
 from ._select import Select
 from .backend import PathFinder
-from .model import Model
-from .trie import MarisaTrie, Trie
-from typing import List, Dict, Any
+
+try:
+    import re2
+except ModuleNotFoundError:
+    re2 = None
+else:
+    # failed compiles fall back to regex, keep re2 from logging them
+    _RE2_OPTIONS = re2.Options()
+    _RE2_OPTIONS.log_errors = False
 
 
 def can_be_int(s):
+    if isinstance(s, str):
+        # check the digits directly, raising ValueError is slow for text options
+        s = s.strip()
+        if s[:1] in ("+", "-"):
+            s = s[1:]
+        return s.isdecimal()
     try:
         int(s)  # Try converting `s` to int
         return True
@@ -24,6 +40,84 @@ def can_be_int(s):
         return False  # Return False if a ValueError is raised
 
 
+# constructs that re2 lacks (lookarounds, inline flags, backreferences) or
+# treats differently: it has ASCII-only \w \d \s \b classes and its $ does
+# not match before a trailing newline or read {,n} as a repeat
+_RE2_UNSAFE = regex.compile(r"\(\?|\\[1-9gwWdDsSbBAZzpPNuUX]|[$^]|\[:|\{,")
+_DIGITS = "0123456789"
+_REGEX_META = frozenset(".^$*+?{}[]\\|()")
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile(pattern, flags=0):
+    return regex.compile(pattern, flags)
+
+
+@functools.lru_cache(maxsize=4096)
+def _compile_linear(pattern, flags=0):
+    # Patterns that mean the same on both engines run on re2's linear-time
+    # one; anything else stays on the backtracking regex module.
+    if re2 is not None and not _RE2_UNSAFE.search(pattern):
+        try:
+            return re2.compile(
+                "(?s)" + pattern if flags & regex.DOTALL else pattern, _RE2_OPTIONS
+            )
+        except re2.error:
+            pass
+    return _compile(pattern, flags)
+
+
+@functools.lru_cache(maxsize=4096)
+def _escape(value):
+    return regex.escape(value)
+
+
+@functools.lru_cache(maxsize=1024)
+def _all_int(options):
+    return all(can_be_int(x) for x in options)
+
+
+@functools.lru_cache(maxsize=1024)
+def _select_pattern(options):
+    return r"(" + r"|".join([_escape(o) for o in options]) + r")"
+
+
+def _scan_int(text, pos=0):
+    # span of the first run of decimal digits, like (\d+), without going
+    # through the regex engine
+    if text.isascii():
+        hits = (text.find(d, pos) for d in _DIGITS)
+        start = min((i for i in hits if i >= 0), default=-1)
+    else:
+        # other scripts have decimal digits too, e.g. Arabic-Indic
+        start = next((i for i in range(pos, len(text)) if text[i].isdecimal()), -1)
+    if start < 0:
+        return None
+    end = start + 1
+    while end < len(text) and text[end].isdecimal():
+        end += 1
+    return start, end, end
+
+
+def _scan_to_end(text, pos=0):
+    # without a stop, a Gen takes the rest of the response
+    return pos, len(text), len(text)
+
+
+def _scan_literal_stop(stop, text, pos=0):
+    idx = text.find(stop, pos)
+    if idx < 0:
+        return None
+    return pos, idx, idx + len(stop)
+
+
+def _scan_regex(pattern, text, pos=0):
+    match = pattern.search(text, pos)
+    if match is None:
+        return None
+    return match.start(), match.end(1), match.end()
+
+
 class ModelAPI(PathFinder):
     token_in = 0
     token_out = 0
@@ -39,6 +133,23 @@ class ModelAPI(PathFinder):
         self.prefix_text = ""
         self.api_assistant = api_assistant
 
+    @property
+    def prefix_text(self):
+        # parts are only joined when the prefix is read, so consuming many
+        # assistant strings does not copy the whole prefix each time
+        if len(self._prefix_parts) > 1:
+            self._prefix_parts = ["".join(self._prefix_parts)]
+        return self._prefix_parts[0] if self._prefix_parts else ""
+
+    @prefix_text.setter
+    def prefix_text(self, value):
+        self._prefix_parts = [value] if value else []
+
+    def copy(self):
+        new_lm = super().copy()
+        new_lm._prefix_parts = self._prefix_parts.copy()
+        return new_lm
+
     def _current_prompt(self):
         if isinstance(self.chat, list):
             prompt_render = str(self.chat)
@@ -47,14 +158,10 @@ class ModelAPI(PathFinder):
         return prompt_render
 
     def _consume_assistant_text(self, value):
-        self.prefix_text += value
-        match = regex.match(
-            r"(.*?)" + regex.escape(value) + r"(.*?)",
-            self.text_to_consume,
-            regex.DOTALL,
-        )
-        if match:
-            self.text_to_consume = self.text_to_consume[len(match.group()) :]
+        self._prefix_parts.append(value)
+        idx = self.text_to_consume.find(value)
+        if idx >= 0:
+            self.text_to_consume = self.text_to_consume[idx + len(value) :]
             self.prefix_text = ""
         else:
             self.text_to_consume = ""
@@ -63,12 +170,21 @@ class ModelAPI(PathFinder):
         self.temperature = value.temperature
         self.top_p = value.top_p
         self.max_tokens = value.max_tokens
-        if value.stop_regex is None:
+        stop = value.stop_regex
+        if isinstance(stop, (list, tuple)):
+            # several stop patterns, as the transformers backend accepts
+            stop = "|".join(stop)
+        if not stop:
             r = r"(.*?)"
+            scan = _scan_to_end
+        elif isinstance(stop, str) and _REGEX_META.isdisjoint(stop):
+            r = rf"(.*?)({stop})"
+            scan = functools.partial(_scan_literal_stop, stop)
         else:
-            r = rf"(.*?)({value.stop_regex})"
+            r = rf"(.*?)({stop})"
+            scan = None
 
-        return self.run(self, r, value.name, True, value.save_stop_text)
+        return self.run(self, r, value.name, True, value.save_stop_text, scan)
 
     def _get_find(self, value: Find):
         self.temperature = value.temperature
@@ -76,114 +192,129 @@ class ModelAPI(PathFinder):
         return self.run_find(self, value.regex, value.name)
 
     def _get_select(self, value: Select):
-        if all(can_be_int(x) for x in value.options):
-            r = r"(\d+)"
-        else:
-            r = r"("
-            r += r"|".join([regex.escape(o) for o in value.options])
-            r += r")"
+        options = tuple(value.options)
+        if _all_int(options):
+            return self.run(self, r"(\d+)", value.name, False, False, _scan_int)
+        r = _select_pattern(options)
         return self.run(self, r, value.name, False, False)
 
     def request_api(self, chat, tmeperature, top_p, max_tokens):
         raise NotImplementedError
 
-    def run_find(self, lm, r, name):
-        if lm.text_to_consume == "":
+    async def arun_batch(self, chats, concurrency=16):
+        """
+        Requests completions for independent chats concurrently.
+        The blocking request_api calls run on a pool of `concurrency` worker
+        threads, and the results keep the order of `chats`.
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            return await asyncio.gather(
+                *(
+                    loop.run_in_executor(executor, self._request_chat, chat)
+                    for chat in chats
+                )
+            )
+        finally:
+            # on an error or cancellation, don't block the event loop on the
+            # requests still in flight, and drop the ones not started yet
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def run_batch(self, chats, concurrency=16):
+        """
+        Blocking version of arun_batch, usable with or without a running
+        event loop.
+        """
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(self._request_chat, chats))
+
+    def _request_chat(self, chat):
+        return self.request_api(chat, self.temperature, self.top_p, self.max_tokens)
+
+    def _fetch_if_empty(self, lm):
+        # Requests a new response once the previous one is consumed. Returns
+        # None if there was still text to consume, otherwise the offset past
+        # the assistant prefix echoed back at the start of the response.
+        if lm.text_to_consume != "":
+            return None
+        pos = 0
+        tmp_chat = (
+            lm.chat[:-1]
+            if lm.chat[-1]["role"] == "assistant" and lm.chat[-1]["content"] == ""
+            else lm.chat
+        )
+        if self.api_assistant:
+            lm.text_to_consume = self.request_api(
+                tmp_chat, lm.temperature, lm.top_p, lm.max_tokens
+            )
+        else:
             tmp_chat = (
-                lm.chat[:-1]
-                if lm.chat[-1]["role"] == "assistant" and lm.chat[-1]["content"] == ""
-                else lm.chat
+                tmp_chat[:-1] if tmp_chat[-1]["role"] == "assistant" else tmp_chat
             )
-            if self.api_assistant:
-                lm.text_to_consume = self.request_api(
-                    tmp_chat, lm.temperature, lm.top_p, lm.max_tokens
-                )
-            else:
-                tmp_chat = (
-                    tmp_chat[:-1] if tmp_chat[-1]["role"] == "assistant" else tmp_chat
-                )
-                lm.text_to_consume = self.request_api(
-                    tmp_chat, lm.temperature, lm.top_p, lm.max_tokens
-                )
-                match = regex.match(
-                    regex.escape(lm.prefix_text) + r"(.*?)",
-                    lm.text_to_consume,
-                    regex.DOTALL,
-                )
-                if match:
-                    lm.text_to_consume = lm.text_to_consume[len(match.group()) :]
-                    lm.prefix_text = ""
+            lm.text_to_consume = self.request_api(
+                tmp_chat, lm.temperature, lm.top_p, lm.max_tokens
+            )
+            if lm.text_to_consume.startswith(lm.prefix_text):
+                pos = len(lm.prefix_text)
+                lm.prefix_text = ""
+        return pos
+
+    def run_find(self, lm, r, name):
+        pos = self._fetch_if_empty(lm)
+        if pos:
+            lm.text_to_consume = lm.text_to_consume[pos:]
 
         original_res = lm.text_to_consume
-        match = regex.search(r, lm.text_to_consume)
+        match = _compile(r).search(original_res)
         if match:
             res = match.group(0)
             lm._variables[name] = res
             return res, original_res
         else:
-            raise Exception(f"Regex {r} not found in {lm.text_to_consume}")
-
-    def run(self, lm, r, name, is_gen, save_stop_text):
-        if lm.text_to_consume == "":
-            tmp_chat = (
-                lm.chat[:-1]
-                if lm.chat[-1]["role"] == "assistant" and lm.chat[-1]["content"] == ""
-                else lm.chat
-            )
-            if self.api_assistant:
-                lm.text_to_consume = self.request_api(
-                    tmp_chat, lm.temperature, lm.top_p, lm.max_tokens
-                )
-            else:
-                tmp_chat = (
-                    tmp_chat[:-1] if tmp_chat[-1]["role"] == "assistant" else tmp_chat
-                )
-                lm.text_to_consume = self.request_api(
-                    tmp_chat, lm.temperature, lm.top_p, lm.max_tokens
-                )
-                match = regex.match(
-                    regex.escape(lm.prefix_text) + r"(.*?)",
-                    lm.text_to_consume,
-                    regex.DOTALL,
-                )
-                if match:
-                    lm.text_to_consume = lm.text_to_consume[len(match.group()) :]
-                    lm.prefix_text = ""
-
-            # remove any prefix, if any
+            raise Exception(f"Regex {r} not found in {original_res}")
+
+    def run(self, lm, r, name, is_gen, save_stop_text, scan=None):
+        # offset of the first unconsumed character; a fresh response is not
+        # sliced, matching simply starts after any echoed prefix
+        pos = self._fetch_if_empty(lm)
+        if pos is None:
+            pos = 0
+        else:
+            # skip any prefix, if any
             p = lm.chat[-1]["content"].strip()
-            if lm.text_to_consume.startswith(p):
-                lm.text_to_consume = lm.text_to_consume[len(p) :]
-
-        if regex.search(r, lm.text_to_consume):
-            match = regex.match(r + r"(.*?)", lm.text_to_consume, regex.DOTALL)
-            if match:
+            if lm.text_to_consume.startswith(p, pos):
+                pos += len(p)
+
+        text = lm.text_to_consume
+        # scan returns (start, end of group 1, end) of the first match, or None
+        if scan is None:
+            scan = functools.partial(_scan_regex, _compile_linear(r, regex.DOTALL))
+        span = scan(text, pos)
+        if span is not None:
+            start, group_end, end = span
+            if start == pos:
                 # complete match
-                match_res = match.group()
-                if save_stop_text:
-                    res = match.group()
-                    lm.text_to_consume = lm.text_to_consume[len(match_res) :]
-                else:
-                    res = match.group(1)
-                    lm.text_to_consume = lm.text_to_consume[len(match.group(1)) :]
+                cut = end if save_stop_text else group_end
+                res = text[pos:cut]
+                lm.text_to_consume = text[cut:]
             else:
-                match = regex.findall(r, lm.text_to_consume, regex.DOTALL)[0]
+                res = text[start:group_end]
                 lm.text_to_consume = ""  # reset since this was a search of the response
-                res = match
         elif is_gen:
             # not stop token
-            res = lm.text_to_consume
+            res = text[pos:]
             lm.text_to_consume = ""
         else:
+            lm.text_to_consume = text[pos:]
             raise Exception(f"Cant find {r} in {lm.text_to_consume}")
         return res
 
 class DeepSeekAPI(ModelAPI):
     def __init__(self, model_name, seed):
         super().__init__(model_name, seed)
-        from openai import OpenAI
+        from openai import OpenAI, RateLimitError
         from dotenv import load_dotenv
-        import os
 
         load_dotenv()  # Load the .env file
         api_key = os.getenv("DEEPSEEK_API_KEY")  # Get the OpenAI API key
@@ -191,14 +322,12 @@ class DeepSeekAPI(ModelAPI):
         self.client = OpenAI(api_key=api_key,
                              base_url="https://api.deepseek.com")
 
-    def request_api(self, chat, tmeperature, top_p, max_tokens):
-        import openai
-
-        @backoff.on_exception(backoff.expo, openai.RateLimitError)
-        def completions_with_backoff(**kwargs):
-            return self.client.chat.completions.create(**kwargs)
+        self.completions_with_backoff = backoff.on_exception(
+            backoff.expo, RateLimitError
+        )(self.client.chat.completions.create)
 
-        out = completions_with_backoff(
+    def request_api(self, chat, tmeperature, top_p, max_tokens):
+        out = self.completions_with_backoff(
             model=self.model_name,
             messages=chat,
             temperature=tmeperature,
@@ -206,7 +335,7 @@ class DeepSeekAPI(ModelAPI):
             seed=self.seed,
             max_tokens=max_tokens,
         )
-        logging.info(f"OpenAI system_fingerprint: {out.system_fingerprint}")
+        logging.info("OpenAI system_fingerprint: %s", out.system_fingerprint)
         return out.choices[0].message.content
     
 class HumanAPI(ModelAPI):
@@ -269,23 +398,20 @@ class HumanAPI(ModelAPI):
 class OpenAIAPI(ModelAPI):
     def __init__(self, model_name, seed):
         super().__init__(model_name, seed)
-        from openai import OpenAI
+        from openai import OpenAI, RateLimitError
         from dotenv import load_dotenv
-        import os
 
         load_dotenv()  # Load the .env file
         api_key = os.getenv("OPENAI_API_KEY")  # Get the OpenAI API key
 
         self.client = OpenAI(api_key=api_key)
 
-    def request_api(self, chat, tmeperature, top_p, max_tokens):
-        import openai
-
-        @backoff.on_exception(backoff.expo, openai.RateLimitError)
-        def completions_with_backoff(**kwargs):
-            return self.client.chat.completions.create(**kwargs)
+        self.completions_with_backoff = backoff.on_exception(
+            backoff.expo, RateLimitError
+        )(self.client.chat.completions.create)
 
-        out = completions_with_backoff(
+    def request_api(self, chat, tmeperature, top_p, max_tokens):
+        out = self.completions_with_backoff(
             model=self.model_name,
             messages=chat,
             temperature=tmeperature,
@@ -293,30 +419,26 @@ class OpenAIAPI(ModelAPI):
             seed=self.seed,
             max_tokens=max_tokens,
         )
-        logging.info(f"OpenAI system_fingerprint: {out.system_fingerprint}")
+        logging.info("OpenAI system_fingerprint: %s", out.system_fingerprint)
         return out.choices[0].message.content
 
 
 class OpenRouter(ModelAPI):
     def __init__(self, model_name, seed):
         super().__init__(model_name, seed)
-        from os import getenv
-
-        from openai import OpenAI
+        from openai import OpenAI, RateLimitError
 
         self.client = OpenAI(
             base_url="https://openrouter.ai/api/v1",
-            api_key=getenv("OPENROUTER_API_KEY"),
+            api_key=os.getenv("OPENROUTER_API_KEY"),
         )
 
-    def request_api(self, chat, tmeperature, top_p, max_tokens):
-        import openai
-
-        @backoff.on_exception(backoff.expo, openai.RateLimitError)
-        def completions_with_backoff(**kwargs):
-            return self.client.chat.completions.create(**kwargs)
+        self.completions_with_backoff = backoff.on_exception(
+            backoff.expo, RateLimitError
+        )(self.client.chat.completions.create)
 
-        out = completions_with_backoff(
+    def request_api(self, chat, tmeperature, top_p, max_tokens):
+        out = self.completions_with_backoff(
             model=self.model_name,
             messages=chat,
             temperature=tmeperature,
@@ -324,12 +446,11 @@ class OpenRouter(ModelAPI):
             seed=self.seed,
             max_tokens=max_tokens,
         )
-        logging.info(f"OpenAI system_fingerprint: {out.system_fingerprint}")
+        logging.info("OpenAI system_fingerprint: %s", out.system_fingerprint)
         return out.choices[0].message.content
 
 
-import json
-import os
+_token_usage_lock = threading.Lock()
 
 
 def append_token_usage(token_in, token_out, model, file_name):
@@ -359,6 +480,13 @@ def append_token_usage(token_in, token_out, model, file_name):
         "model": model,
     }
 
+    # Requests may run concurrently (see ModelAPI.run_batch), and the append
+    # below seeks back over the closing bracket, so it must not interleave
+    with _token_usage_lock:
+        _write_token_usage(file_path, new_entry)
+
+
+def _write_token_usage(file_path, new_entry):
     # Check if file exists and is not empty
     if os.path.isfile(file_path) and os.path.getsize(file_path) > 0:
         # Open the file in read/write mode
@@ -376,25 +504,20 @@ def append_token_usage(token_in, token_out, model, file_name):
             json.dump([new_entry], file, indent=4)
 
 
-import uuid
-
-
 class AzureOpenAIAPI(ModelAPI):
     def __init__(self, model_name, seed):
         super().__init__(model_name, seed)
-        from openai import AzureOpenAI
+        from openai import AzureOpenAI, RateLimitError
 
         self.client = AzureOpenAI()
         self.random_name = str(uuid.uuid4())
 
-    def request_api(self, chat, tmeperature, top_p, max_tokens):
-        import openai
+        self.completions_with_backoff = backoff.on_exception(
+            backoff.expo, RateLimitError
+        )(self.client.chat.completions.create)
 
-        @backoff.on_exception(backoff.expo, openai.RateLimitError)
-        def completions_with_backoff(**kwargs):
-            return self.client.chat.completions.create(**kwargs)
-
-        out = completions_with_backoff(
+    def request_api(self, chat, tmeperature, top_p, max_tokens):
+        out = self.completions_with_backoff(
             model=self.model_name,
             messages=chat,
             temperature=tmeperature,
@@ -402,50 +525,39 @@ class AzureOpenAIAPI(ModelAPI):
             seed=self.seed,
             max_tokens=max_tokens,
         )
-        logging.info(f"OpenAI system_fingerprint: {out.system_fingerprint}")
+        logging.info("OpenAI system_fingerprint: %s", out.system_fingerprint)
 
-        self.token_in = out.usage.prompt_tokens
-        self.token_out = out.usage.completion_tokens
+        # usage of this request, instance attributes are shared between the
+        # threads of run_batch
+        token_in = out.usage.prompt_tokens
+        token_out = out.usage.completion_tokens
+        self.token_in, self.token_out = token_in, token_out
 
-        append_token_usage(
-            self.token_in, self.token_out, self.model_name, self.random_name
-        )
+        append_token_usage(token_in, token_out, self.model_name, self.random_name)
 
         return out.choices[0].message.content
 
 
-import os
-
-
 class MistralAPI(ModelAPI):
     def __init__(self, model_name, seed):
         super().__init__(model_name, seed, api_assistant=False)
         from httpx import Client as HTTPClient
         from httpx import HTTPTransport
         from mistralai.client import MistralClient
+        from mistralai.exceptions import MistralException
+        from mistralai.models.chat_completion import ChatMessage
 
         api_key = os.environ["MISTRAL_API_KEY"]
         self.client = MistralClient(api_key=api_key)
 
-        http_proxies = [
-            proxy
-            for varname, proxy in os.environ.items()
-            if varname.lower() == "http_proxy"
-        ]
-        https_proxies = [
-            proxy
-            for varname, proxy in os.environ.items()
-            if varname.lower() == "https_proxy"
-        ]
-        all_proxies = [
-            proxy
-            for varname, proxy in os.environ.items()
-            if varname.lower() == "all_proxy"
-        ]
+        # case-insensitive lookup, keeping the first matching variable
+        env_lower = {}
+        for varname, proxy in os.environ.items():
+            env_lower.setdefault(varname.lower(), proxy)
         proxies = {
-            "http://": http_proxies[0] if len(http_proxies) > 0 else None,
-            "https://": https_proxies[0] if len(https_proxies) > 0 else None,
-            "all://": all_proxies[0] if len(all_proxies) > 0 else None,
+            "http://": env_lower.get("http_proxy"),
+            "https://": env_lower.get("https_proxy"),
+            "all://": env_lower.get("all_proxy"),
         }
 
         self.client._client = HTTPClient(
@@ -455,24 +567,22 @@ class MistralAPI(ModelAPI):
             transport=HTTPTransport(retries=self.client._max_retries),
         )
 
-    def request_api(self, chat, tmeperature, top_p, max_tokens):
-        from mistralai.exceptions import MistralException
-
-        @backoff.on_exception(backoff.expo, MistralException)
-        def completions_with_backoff(**kwargs):
-            return self.client.chat(**kwargs)
-
-        from mistralai.models.chat_completion import ChatMessage
+        self.completions_with_backoff = backoff.on_exception(
+            backoff.expo, MistralException
+        )(self.client.chat)
+        self.chat_message = ChatMessage
 
+    def request_api(self, chat, tmeperature, top_p, max_tokens):
         if chat[-1]["role"] == "assistant":
             raise Exception(
                 "Assistant should not be the last role in the chat for Mistral."
             )
 
+        chat_message = self.chat_message
         chat_mistral = [
-            ChatMessage(role=entry["role"], content=entry["content"]) for entry in chat
+            chat_message(role=entry["role"], content=entry["content"]) for entry in chat
         ]
-        out = completions_with_backoff(
+        out = self.completions_with_backoff(
             model=self.model_name,
             messages=chat_mistral,
             temperature=tmeperature,
@@ -487,22 +597,20 @@ class AnthropicAPI(ModelAPI):
     def __init__(self, model_name, seed):
         super().__init__(model_name, seed, api_assistant=False)
         from anthropic import Anthropic
+        from anthropic._exceptions import APIStatusError
 
         self.client = Anthropic()
+        self.completions_with_backoff = backoff.on_exception(
+            backoff.expo, APIStatusError
+        )(self.client.messages.create)
 
     def request_api(self, chat, tmeperature, top_p, max_tokens):
-        from anthropic._exceptions import APIStatusError
-
-        @backoff.on_exception(backoff.expo, APIStatusError)
-        def completions_with_backoff(**kwargs):
-            return self.client.messages.create(**kwargs)
-
         if chat[-1]["role"] == "assistant":
             raise Exception(
                 "Assistant should not be the last role in the chat for Anthropic."
             )
 
-        out = completions_with_backoff(
+        out = self.completions_with_backoff(
             model=self.model_name,
             messages=chat,
             temperature=tmeperature,
@@ -1,105 +1,60 @@
+import functools
 import os
 
-from transformers import PreTrainedModel, PreTrainedTokenizer
 
-from .model import Model
+@functools.lru_cache(maxsize=None)
+def _load_template(rel_path):
+    template_path = os.path.join(os.path.dirname(__file__), rel_path)
+    with open(template_path) as f:
+        chat_template = f.read()
+    return chat_template.replace("    ", "").replace("\n", "")
 
 
 class LlamaChat:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/llama-2-chat.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/llama-2-chat.jinja")
 
 
 class Llama3Chat:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/llama-3-chat.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/llama-3-chat.jinja")
 
 
 class MixtralInstruct:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/mistral-instruct.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/mistral-instruct.jinja")
 
 
 class Vicuna:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/vicuna.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/vicuna.jinja")
 
 
 class ChatML:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/chatml.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/chatml.jinja")
 
 
 class Phi3:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/phi-3.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/phi-3.jinja")
 
 
 class DeepSeek:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/deep_seek.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/deep_seek.jinja")
 
 
 class MetaMath:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/alpaca.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/alpaca.jinja")
 
 
 class MistralInstruct:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/mistral-instruct.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/mistral-instruct.jinja")
 
 
 class Cohere:
     def __init__(self):
-        template_path = os.path.join(
-            os.path.dirname(__file__), "./templates_jinja/cohere.jinja"
-        )
-        chat_template = open(template_path).read()
-        chat_template = chat_template.replace("    ", "").replace("\n", "")
-        self.template = chat_template
+        self.template = _load_template("templates_jinja/cohere.jinja")
@@ -1,7 +1,3 @@
-import torch
-from accelerate import infer_auto_device_map
-from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
-
 from .api import AnthropicAPI, AzureOpenAIAPI, MistralAPI, OpenAIAPI, OpenRouter, DeepSeekAPI, HumanAPI
 from .chat import (
     ChatML,
@@ -12,11 +8,9 @@ from .chat import (
     MetaMath,
     MistralInstruct,
     MixtralInstruct,
-    Model,
     Phi3,
     Vicuna,
 )
-from .model import Model
 
 
 def get_api_model(name, seed):
@@ -44,6 +38,8 @@ def get_gpu_memory_no_reserve(gpu_list):
     Detect the total memory on each GPU in the list without reserving extra overhead.
     Returns a dictionary mapping each GPU to its total memory.
     """
+    import torch
+
     max_memory = {}
     for gpu in gpu_list:
         total_memory = torch.cuda.get_device_properties(gpu).total_memory
@@ -55,6 +51,8 @@ def get_available_gpus():
     """
     Returns a list of all available GPUs in the format [0, 1, ...].
     """
+    import torch
+
     if not torch.cuda.is_available():
         return []  # No GPUs available
     return [i for i in range(torch.cuda.device_count())]
@@ -67,10 +65,16 @@ def get_model(
     backend_name="transformers",
     gpu_list=None,
 ):
-    if gpu_list is None:
-        gpu_list = get_available_gpus()
     if is_api:
         return get_api_model(name, seed)
+    # the transformers stack is only needed for local models
+    import torch
+    from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+    from .model import Model
+
+    if gpu_list is None:
+        gpu_list = get_available_gpus()
     trust_remote_code = False
     use_fast = True
     extend_context_length = True
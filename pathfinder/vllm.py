@@ -22,18 +22,11 @@ from vllm import LLM, SamplingParams
 from ._find import Find
 from ._gen import Gen
 from ._select import Select
+from .api import _escape, can_be_int
 from .backend import PathFinder
 from .trie import MarisaTrie, Trie
 
 
-def can_be_int(s):
-    try:
-        int(s)  # Try converting `s` to int
-        return True
-    except ValueError:
-        return False  # Return False if a ValueError is raised
-
-
 class ModelVLLMBackend(PathFinder):
     def __init__(
         self,
@@ -73,13 +66,9 @@ class ModelVLLMBackend(PathFinder):
 
     def _consume_assistant_text(self, value):
         self.prefix_text += value
-        match = regex.match(
-            r"(.*?)" + regex.escape(value) + r"(.*?)",
-            self.text_to_consume,
-            regex.DOTALL,
-        )
-        if match:
-            self.text_to_consume = self.text_to_consume[len(match.group()) :]
+        idx = self.text_to_consume.find(value)
+        if idx >= 0:
+            self.text_to_consume = self.text_to_consume[idx + len(value) :]
             self.prefix_text = ""
         else:
             self.text_to_consume = ""
@@ -105,7 +94,7 @@ class ModelVLLMBackend(PathFinder):
             r = r"(\d+)"
         else:
             r = r"("
-            r += r"|".join([regex.escape(o) for o in value.options])
+            r += r"|".join([_escape(o) for o in value.options])
             r += r")"
         return self.run(self, r, value.name, False, False)
 
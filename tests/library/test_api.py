@@ -0,0 +1,307 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import regex
+
+from pathfinder import api, assistant, find, gen, select, user
+from pathfinder.api import (
+    ModelAPI,
+    _compile,
+    _compile_linear,
+    _scan_int,
+    _scan_literal_stop,
+    _scan_regex,
+    _scan_to_end,
+    can_be_int,
+)
+
+
+@pytest.mark.parametrize(
+    "stop, text",
+    [
+        (r"\w+", "ééc1"),
+        (r"Y$", "YY\n"),
+        (r"\d", "a٣2"),
+        (r"\s", "a b c"),
+        (r"\bé", "aé é"),
+        (r"[^a]", "aab"),
+        (r"ab|b", "xxab"),
+        (r"b+?", "abbb"),
+        (r"\.", "a.b"),
+        (r"é{2}", "éaéé"),
+        (r"a{,2}b", "xab"),
+        (r"x{,}", "x{,}"),
+    ],
+)
+def test_compile_linear_matches_regex(stop, text):
+    pytest.importorskip("re2")
+    r = rf"(.*?)({stop})"
+    for pos in range(len(text) + 1):
+        expected = _scan_regex(_compile(r, regex.DOTALL), text, pos)
+        assert _scan_regex(_compile_linear(r, regex.DOTALL), text, pos) == expected
+
+
+@pytest.mark.parametrize(
+    "text, pos, span",
+    [
+        ("42 is it", 0, (0, 2, 2)),
+        ("The answer is 10", 0, (14, 16, 16)),
+        ("10 and 20", 3, (7, 9, 9)),
+        ("٣", 0, (0, 1, 1)),
+        (" ٣2", 0, (1, 3, 3)),
+        ("x²", 0, None),
+        ("no digits", 0, None),
+    ],
+)
+def test_scan_int(text, pos, span):
+    assert _scan_int(text, pos) == span
+    match = regex.compile(r"(\d+)").search(text, pos)
+    assert span == (
+        None if match is None else (match.start(), match.end(), match.end())
+    )
+
+
+class SlowAPI(ModelAPI):
+    def __init__(self):
+        super().__init__("stub", 0)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def request_api(self, chat, temperature, top_p, max_tokens):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        return chat[-1]["content"].upper()
+
+
+def test_run_batch_keeps_order_and_concurrency():
+    lm = SlowAPI()
+    chats = [[{"role": "user", "content": f"q{i}"}] for i in range(40)]
+    assert lm.run_batch(chats, concurrency=40) == [f"Q{i}" for i in range(40)]
+    # not capped by the default executor size
+    assert lm.peak == 40
+
+
+def test_arun_batch_and_run_batch_inside_event_loop():
+    lm = SlowAPI()
+    chats = [[{"role": "user", "content": f"q{i}"}] for i in range(8)]
+
+    async def main():
+        return await lm.arun_batch(chats, concurrency=4), lm.run_batch(chats)
+
+    res_async, res_sync = asyncio.run(main())
+    assert res_async == res_sync == [f"Q{i}" for i in range(8)]
+    assert lm.peak == 8
+
+
+class FailingAPI(ModelAPI):
+    def __init__(self):
+        super().__init__("stub", 0)
+        self.started = []
+
+    def request_api(self, chat, temperature, top_p, max_tokens):
+        content = chat[-1]["content"]
+        self.started.append(content)
+        if content == "bad":
+            raise ValueError(content)
+        time.sleep(0.5)
+        return content
+
+
+def test_arun_batch_error_does_not_block_loop():
+    lm = FailingAPI()
+    chats = [[{"role": "user", "content": c}] for c in ["slow", "bad", "q2", "q3"]]
+
+    async def main():
+        start = time.monotonic()
+        with pytest.raises(ValueError):
+            await lm.arun_batch(chats, concurrency=2)
+        return time.monotonic() - start
+
+    # returns without waiting for the slow requests, queued ones never start
+    assert asyncio.run(main()) < 0.4
+    time.sleep(0.6)
+    assert "q3" not in lm.started
+
+
+def test_append_token_usage_concurrent(tmp_path, monkeypatch):
+    monkeypatch.setattr(api, "__file__", str(tmp_path / "a" / "b" / "api.py"))
+    dumps = json.dumps
+
+    def slow_dumps(obj):
+        # widen the window between the seek and the write of an append
+        time.sleep(0.001)
+        return dumps(obj)
+
+    monkeypatch.setattr(api.json, "dumps", slow_dumps)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for i in range(64):
+            executor.submit(
+                api.append_token_usage, i, 1, "gpt-4-turbo-2024-04-09", "usage"
+            )
+    with open(tmp_path / "api_usage" / "usage.json") as f:
+        entries = json.load(f)
+    assert sorted(e["token_in"] for e in entries) == list(range(64))
+
+
+class StubAPI(ModelAPI):
+    def __init__(self, responses, api_assistant=True):
+        super().__init__("stub", 0, api_assistant=api_assistant)
+        self.responses = list(responses)
+        self.requests = []
+
+    def request_api(self, chat, temperature, top_p, max_tokens):
+        self.requests.append(chat)
+        return self.responses.pop(0)
+
+
+def ask(lm, *steps):
+    with user():
+        lm += "Question?"
+    with assistant():
+        for step in steps:
+            lm += step
+    return lm
+
+
+@pytest.mark.parametrize(
+    "s, expected",
+    [
+        ("42", True),
+        (" -7 ", True),
+        ("+3", True),
+        ("٣", True),
+        ("+-5", False),
+        ("", False),
+        ("1.5", False),
+        ("apples", False),
+        (5, True),
+        (2.5, True),
+    ],
+)
+def test_can_be_int(s, expected):
+    assert can_be_int(s) is expected
+
+
+def test_scan_literal_stop_and_to_end():
+    assert _scan_literal_stop("\n", "ab\ncd\n", 0) == (0, 2, 3)
+    assert _scan_literal_stop("\n", "ab\ncd\n", 3) == (3, 5, 6)
+    assert _scan_literal_stop("</s>", "no stop", 0) is None
+    assert _scan_to_end("abcdef", 2) == (2, 6, 6)
+
+
+def test_select_complete_match_keeps_rest():
+    lm = ask(StubAPI(["oranges, for sure"]), select(["apples", "oranges"], name="a"))
+    assert lm["a"] == "oranges"
+    assert lm.text_to_consume == ", for sure"
+
+
+def test_select_match_after_start_resets_buffer():
+    lm = ask(
+        StubAPI(["I'd say oranges, really"]), select(["apples", "oranges"], name="a")
+    )
+    assert lm["a"] == "oranges"
+    assert lm.text_to_consume == ""
+
+
+def test_select_int_after_start():
+    lm = ask(
+        StubAPI(["The answer is 10."]), "The answer is ", select(["1", "10"], name="a")
+    )
+    assert lm["a"] == "10"
+    assert lm.text_to_consume == ""
+
+
+@pytest.mark.parametrize("stop", [";", r";|!"])
+@pytest.mark.parametrize(
+    "save_stop_text, value, rest",
+    [(False, "tasty", ";\nmore"), (True, "tasty;", "\nmore")],
+)
+def test_gen_save_stop_text(stop, save_stop_text, value, rest):
+    lm = ask(
+        StubAPI(["tasty;\nmore"]),
+        gen(name="a", stop_regex=stop, save_stop_text=save_stop_text),
+    )
+    assert lm["a"] == value
+    assert lm.text_to_consume == rest
+
+
+def test_gen_regex_stop():
+    lm = ask(StubAPI(["one! two."]), gen(name="a", stop_regex=r"\.|!"))
+    assert lm["a"] == "one"
+    assert lm.text_to_consume == "! two."
+
+
+def test_gen_stop_never_found_takes_rest():
+    lm = ask(StubAPI(["no stop here"]), gen(name="a", stop_regex="</s>"))
+    assert lm["a"] == "no stop here"
+    assert lm.text_to_consume == ""
+
+
+def test_select_never_found_raises():
+    lm = ask(StubAPI(["Answer: bananas"], api_assistant=False), "Answer:")
+    with pytest.raises(Exception, match="Cant find"):
+        lm._get_select(select(["apples", "oranges"], name="a"))
+    # the echoed prefix is consumed even though nothing matched
+    assert lm.text_to_consume == " bananas"
+
+
+def test_echoed_assistant_prefix_is_skipped():
+    lm = StubAPI(["Answer: apples\nbecause"], api_assistant=False)
+    lm = ask(lm, "Answer: ", select(["apples", "oranges"], name="a"))
+    assert lm["a"] == "apples"
+    assert lm.text_to_consume == "\nbecause"
+    assert lm.prefix_text == ""
+    # the assistant turn is not sent to APIs without assistant prefill
+    assert [m["role"] for m in lm.requests[0]] == ["user"]
+
+
+def test_fetch_if_empty():
+    lm = ask(StubAPI(["Answer: yes"], api_assistant=False), "Answer: ")
+    assert lm.text_to_consume == ""
+    assert lm._fetch_if_empty(lm) == len("Answer: ")
+    assert lm.text_to_consume == "Answer: yes"
+    assert lm._fetch_if_empty(lm) is None
+    assert lm.requests == [[{"role": "user", "content": "Question?"}]]
+
+
+def test_find_strips_echoed_prefix():
+    lm = StubAPI(["Answer: 42 apples"], api_assistant=False)
+    lm = ask(lm, "Answer: ", find(regex=r"\d+", name="a"))
+    assert lm["a"] == "42"
+    assert lm.text_to_consume == "42 apples"
+
+
+def test_gen_without_stop_takes_rest():
+    # gen() defaults to stop_regex=[]
+    lm = ask(StubAPI(["whole thing\nhere"]), gen(name="a"))
+    assert lm["a"] == "whole thing\nhere"
+    assert lm.text_to_consume == ""
+
+
+def test_gen_without_stop_after_stop():
+    lm = ask(
+        StubAPI(["first\nsecond\nthird"]),
+        gen(name="a", stop_regex="\n"),
+        gen(name="b", stop_regex=None),
+    )
+    assert lm["a"] == "first"
+    assert lm["b"] == "\nsecond\nthird"
+    assert lm.requests == [[{"role": "user", "content": "Question?"}]]
+
+
+@pytest.mark.parametrize(
+    "stop, value",
+    [([r"\.", "!"], "one"), ([r"\d"], "one! two. "), (["</s>"], "one! two. 3")],
+)
+def test_gen_list_stop(stop, value):
+    lm = ask(StubAPI(["one! two. 3"]), gen(name="a", stop_regex=stop))
+    assert lm["a"] == value